@@ -3,60 +3,126 @@ vLLM Proxy - FastAPI 서버
 모든 요청을 vLLM 백엔드로 패스스루하고, 요청 프롬프트/토큰수/응답 프롬프트를 로그 출력합니다.
 """
 
-import json
+import functools
 import logging
 import os
+import queue
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from typing import Any
 
 import httpx
+import msgspec
+import orjson
+import simdjson
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
-logger = logging.getLogger("vllm-proxy")
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+VLLM_BASE_URL = os.getenv("VLLM_BASE_URL", "http://localhost:5678").rstrip("/")
+PROXY_TIMEOUT = float(os.getenv("PROXY_TIMEOUT", "300"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# 프롬프트(messages/prompt)/응답 로깅 대상 추론 엔드포인트. stream 플래그 판별은 경로와 무관하게 수행
+# uvicorn이 직접 붙이는 date/server와 hop-by-hop 헤더는 업스트림 응답에서 전달하지 않음
+_DROP_RESPONSE_HEADERS = frozenset({b"date", b"server", b"connection", b"keep-alive", b"transfer-encoding"})
+_PROMPT_PATHS = frozenset({"v1/chat/completions", "v1/completions", "chat/completions", "completions"})
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """루트 로거의 모든 레코드(httpx 등 서드파티 포함)를 큐에 넣는 핸들러. 큐가 가득 차면 버림.
+
+    메시지는 stdlib prepare()가 호출 시점에 확정하므로 (인자 객체가 나중에 바뀌어도 안전),
+    리스너 스레드로 넘어가는 것은 스트림 출력(I/O)뿐.
+    """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(
+    fmt="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
-)
+))
+log_queue: queue.Queue[logging.LogRecord] = queue.Queue(LOG_QUEUE_SIZE)
+log_listener = QueueListener(log_queue, _log_handler)
 
-app = FastAPI(title="vLLM Proxy", version="1.0.0")
+# prepare()는 메시지만 확정하고, 시간/레벨 등 포맷은 리스너 쪽 _log_handler가 붙임
+_queue_handler = _DroppingQueueHandler(log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
 
-VLLM_BASE_URL = os.getenv("VLLM_BASE_URL", "http://localhost:5678").rstrip("/")
-PROXY_TIMEOUT = float(os.getenv("PROXY_TIMEOUT", "300"))
+logger = logging.getLogger("vllm-proxy")
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """백엔드용 httpx 클라이언트를 앱 수명 동안 공유 (커넥션 풀 재사용)하고 로그 리스너를 구동."""
+    log_listener.start()
+    app.state.client = httpx.AsyncClient(
+        timeout=PROXY_TIMEOUT,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200),
+    )
+    try:
+        yield
+    finally:
+        await app.state.client.aclose()
+        log_listener.stop()
+
+
+app = FastAPI(title="vLLM Proxy", version="1.0.0", lifespan=lifespan)
+
+
+@functools.lru_cache(maxsize=256)
+def _url_for(path: str) -> str:
+    """경로별 백엔드 URL. 엔드포인트 종류가 적으므로 캐시해 매 요청 문자열 조립을 피함."""
+    return f"{VLLM_BASE_URL}/{path}"
+
+
+def _truncate(s: str, n: int = 2000) -> str:
+    """로그용 문자열을 n자로 자름. 잘린 경우 '...' 표시."""
+    return s if len(s) <= n else s[:n] + "..."
+
+
+def _part_text(c: Any) -> str:
+    """multimodal content 파트에서 로그용 텍스트 추출."""
+    if isinstance(c, dict):
+        return c.get("text") or c.get("input") or str(c)
+    return str(c)
+
+
+def _format_message(m: dict[str, Any]) -> str:
+    """메시지 하나를 '[role] content' 로그 줄로 포맷."""
+    role = m.get("role", "unknown")
+    content = m.get("content")
+    if content is None:
+        # content 없음 (tool_calls 등) -> role만이라도 표시
+        extra = " (tool_calls)" if m.get("tool_calls") else ""
+        return f"[{role}] (no content){extra}"
+    if isinstance(content, str):
+        return f"[{role}] {_truncate(content)}"
+    if isinstance(content, list):
+        # multimodal: [{ "type": "text", "text": "..." }, ...]
+        text = " ".join(t for t in map(_part_text, content) if t)
+        return f"[{role}] {_truncate(text)}" if text else f"[{role}] (empty parts)"
+    # 바이트 상태로 먼저 잘라 500자 이후는 디코딩하지 않음 (잘린 멀티바이트 문자는 대체)
+    return f"[{role}] {orjson.dumps(content)[:500].decode('utf-8', errors='replace')}"
 
 
 def extract_prompt_from_body(body: dict[str, Any]) -> str:
     """요청 바디에서 프롬프트(메시지 또는 prompt) 추출."""
     if "messages" in body:
-        parts = []
-        for m in body["messages"]:
-            role = m.get("role", "unknown")
-            content = m.get("content")
-            if content is None:
-                # content 없음 (tool_calls 등) -> role만이라도 표시
-                extra = ""
-                if "tool_calls" in m and m["tool_calls"]:
-                    extra = " (tool_calls)"
-                parts.append(f"[{role}] (no content){extra}")
-            elif isinstance(content, str):
-                parts.append(f"[{role}] {content}")
-            elif isinstance(content, list):
-                # multimodal: [{ "type": "text", "text": "..." }, ...]
-                texts = []
-                for c in content:
-                    if isinstance(c, dict):
-                        texts.append(c.get("text") or c.get("input") or str(c))
-                    else:
-                        texts.append(str(c))
-                parts.append(f"[{role}] " + " ".join(t for t in texts if t))
-                if not texts or not any(t for t in texts):
-                    parts[-1] = f"[{role}] (empty parts)"
-            else:
-                parts.append(f"[{role}] {json.dumps(content)[:500]}")
-        return "\n".join(parts) if parts else json.dumps(body["messages"])
+        messages = body["messages"]
+        if not messages:
+            return orjson.dumps(messages).decode()
+        return "\n".join(_format_message(m) for m in messages)
     if "prompt" in body:
         p = body["prompt"]
-        return p if isinstance(p, str) else json.dumps(p)
+        return _truncate(p) if isinstance(p, str) else orjson.dumps(p).decode()
     return "(prompt not found)"
 
 
@@ -74,55 +140,101 @@ def format_tool_calls(tool_calls: list[Any]) -> str:
         fn = tc.get("function") or {}
         name = fn.get("name", "")
         args = fn.get("arguments", "")
-        if isinstance(args, str) and len(args) > 400:
-            args = args[:400] + "..."
+        if isinstance(args, str):
+            args = _truncate(args, 400)
         lines.append(f"  [{i}] id={tid!r} type={ttype} function.name={name!r}")
         if args:
             lines.append(f"      arguments={args!r}")
     return "\n".join(lines)
 
 
-def extract_usage_from_response(data: dict[str, Any]) -> dict[str, int]:
-    """응답에서 usage(토큰 수) 추출."""
-    usage = data.get("usage") or {}
-    return {
-        "prompt_tokens": usage.get("prompt_tokens", 0),
-        "completion_tokens": usage.get("completion_tokens", 0),
-        "total_tokens": usage.get("total_tokens", 0),
-    }
+class Usage(msgspec.Struct):
+    """응답 usage(토큰 수)."""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+
+class Message(msgspec.Struct):
+    """choices[].message 중 생성 텍스트와 tool_calls."""
+
+    content: Any = None
+    tool_calls: list[Any] | None = None
+
+
+class Choice(msgspec.Struct):
+    """choices[] 항목 (chat은 message, completions는 text)."""
+
+    message: Message | None = None
+    text: str | None = None
+
+
+class Completion(msgspec.Struct):
+    """비스트리밍 응답 중 로깅에 쓰는 필드만 선언 (logprobs 등 나머지 키는 객체로 만들지 않고 건너뜀)."""
+
+    choices: list[Choice] | None = None
+    usage: Usage | None = None
 
 
-def extract_response_text(data: dict[str, Any]) -> str:
+_completion_decoder = msgspec.json.Decoder(Completion)
+
+
+def extract_response_text(data: Completion) -> str:
     """응답에서 생성된 텍스트 추출."""
-    choices = data.get("choices") or []
-    if not choices:
+    if not data.choices:
         return "(no choices)"
-    choice = choices[0]
-    if "message" in choice:
-        msg = choice["message"]
-        content = msg.get("content")
-        return content if isinstance(content, str) else json.dumps(content)
-    if "text" in choice:
-        return choice["text"]
+    choice = data.choices[0]
+    if choice.message is not None:
+        content = choice.message.content
+        return content if isinstance(content, str) else orjson.dumps(content).decode()
+    if choice.text is not None:
+        return choice.text
     return "(no content)"
 
 
+def _response_headers(headers: httpx.Headers) -> list[tuple[bytes, bytes]]:
+    """업스트림 응답 헤더 원본 튜플에서 중복/hop-by-hop 헤더만 한 번에 걸러냄."""
+    return [(k, v) for k, v in headers.raw if k.lower() not in _DROP_RESPONSE_HEADERS]
+
+
+def _at_pointer(doc: Any, pointer: str) -> Any:
+    """simdjson 문서에서 JSON Pointer로 값 조회. 경로가 없으면 None."""
+    try:
+        return doc.at_pointer(pointer)
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
 async def proxy(path: str, request: Request) -> Response:
     """모든 요청을 vLLM 백엔드로 패스스루."""
-    url = f"{VLLM_BASE_URL}/{path}"
+    url = _url_for(path)
     method = request.method
+    # INFO가 걸러지는 경우 로깅용 파싱을 모두 건너뛰고 단순 패스스루
+    log_enabled = logger.isEnabledFor(logging.INFO)
 
-    # 요청 바디 (POST 등)
+    # 스트리밍 여부는 Accept 헤더로 먼저 판단. SSE가 명시되면 로깅 없이는 바디를 볼 필요 없음
+    accept_sse = request.headers.get("accept") == "text/event-stream"
+
+    # 요청 바디 (POST 등): 스트리밍 판별(모든 경로)이나 프롬프트 로깅(추론 엔드포인트)에 필요할 때만 메모리에 올림.
+    # JSON이 아닌 바디(multipart 오디오 등)는 읽지 않고 request.stream()으로 그대로 흘려보냄.
+    # 한계: SSE Accept 없는 JSON 요청은 stream 플래그를 보려면 바디 전체가 필요하므로 여전히 버퍼링됨
+    log_prompt = log_enabled and path in _PROMPT_PATHS
+    is_json = request.headers.get("content-type", "").startswith("application/json")
     body = None
-    if method in ("POST", "PUT", "PATCH") and path.strip():
+    if method in ("POST", "PUT", "PATCH") and path.strip() and is_json and (log_prompt or not accept_sse):
         try:
-            body = await request.json()
+            # Starlette의 request.json()은 stdlib json을 쓰므로 orjson으로 직접 파싱
+            body = orjson.loads(await request.body())
         except Exception:
             body = None
+    # JSON 배열 등 객체가 아닌 바디는 stream 판별/프롬프트 로깅 대상에서 제외
+    body_is_obj = isinstance(body, dict)
+    is_stream = accept_sse or (body_is_obj and bool(body.get("stream")))
 
     # 로깅용: 프롬프트 추출 (chat/completions, completions 등)
-    if body and ("messages" in body or "prompt" in body):
+    if log_prompt and body_is_obj and ("messages" in body or "prompt" in body):
         req_prompt = extract_prompt_from_body(body)
         logger.info("=== REQUEST PROMPT ===\n%s", req_prompt)
         # 요청 메시지에 tool_calls 있으면 툴 정보 로그
@@ -134,58 +246,95 @@ async def proxy(path: str, request: Request) -> Response:
                     if formatted:
                         logger.info("=== REQUEST TOOL CALLS ===\n%s", formatted)
 
-    headers = dict(request.headers)
-    # 호스트 제거해서 백엔드가 자신의 호스트로 받도록
-    headers.pop("host", None)
+    # 원본 헤더 튜플을 그대로 전달하되, 호스트는 제거해서 백엔드가 자신의 호스트로 받도록.
+    # aiter_raw()는 압축을 풀지 않으므로 업스트림에는 비압축(identity) 응답만 요청
+    # (생략하면 httpx 기본값 gzip/deflate가 붙음)
+    headers = [(k, v) for k, v in request.headers.raw if k not in (b"host", b"accept-encoding")]
+    headers.append((b"accept-encoding", b"identity"))
 
-    raw_body = await request.body() if method in ("POST", "PUT", "PATCH") else None
+    # 바디를 읽었다면 request.stream()은 캐시된 바디를, 아니면 수신 청크를 그대로 전달
+    content = request.stream() if method in ("POST", "PUT", "PATCH") else None
+    client: httpx.AsyncClient = request.app.state.client
 
-    if request.headers.get("accept") == "text/event-stream" or (body and body.get("stream")):
-        # 스트리밍: 클라이언트를 제너레이터 안에서 생성해 스트림 수명과 맞춤
+    if is_stream:
+        # 스트리밍
         full_content: list[str] = []
-        stream_usage: dict[str, int] = {}
+        stream_usage: Usage | None = None
         stream_tool_calls: list[dict[str, Any]] = []
+        # 요청 바디 전송은 여기서 끝내야 함 (응답 중 receive는 disconnect 감지가 사용)
+        r = await client.send(client.build_request(method, url, content=content, headers=headers), stream=True)
 
         async def stream():
             nonlocal full_content, stream_usage, stream_tool_calls
-            async with httpx.AsyncClient(timeout=PROXY_TIMEOUT) as client:
-                async with client.stream(method, url, content=raw_body, headers=headers) as r:
-                    async for chunk in r.aiter_bytes():
+            # simdjson Parser는 재사용 시 이전 문서를 무효화하므로 스트림마다 하나씩 사용
+            parser = simdjson.Parser()
+
+            def consume(payload: bytes) -> None:
+                """SSE data 페이로드에서 로깅에 필요한 필드만 지연 파싱으로 추출."""
+                nonlocal stream_usage
+                doc = parser.parse(payload)
+                usage = _at_pointer(doc, "/usage")
+                if usage is not None:
+                    stream_usage = msgspec.convert(usage.as_dict(), Usage)
+                content = _at_pointer(doc, "/choices/0/delta/content")
+                if content:
+                    full_content.append(content)
+                # 스트리밍 툴콜: delta.tool_calls는 index별로 올 수 있음
+                tcs = _at_pointer(doc, "/choices/0/delta/tool_calls")
+                for tc in tcs.as_list() if tcs is not None else []:
+                    if not isinstance(tc, dict):
+                        continue
+                    idx = tc.get("index", len(stream_tool_calls))
+                    while len(stream_tool_calls) <= idx:
+                        stream_tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                    cur = stream_tool_calls[idx]
+                    if tc.get("id"):
+                        cur["id"] = tc["id"]
+                    if tc.get("type"):
+                        cur["type"] = tc["type"]
+                    fn = cur.setdefault("function", {"name": "", "arguments": ""})
+                    if tc.get("function"):
+                        if tc["function"].get("name"):
+                            fn["name"] = tc["function"]["name"]
+                        if tc["function"].get("arguments"):
+                            fn["arguments"] = (fn.get("arguments") or "") + tc["function"]["arguments"]
+
+            # 청크는 SSE 이벤트 경계와 무관하게 잘려 오므로 버퍼에 모아 완결된 이벤트만 파싱
+            buf = bytearray()
+
+            def drain() -> None:
+                """버퍼에서 빈 줄로 끝난 완결 이벤트만 파싱하고, 미완성 꼬리는 남겨둠."""
+                end = buf.rfind(b"\n\n")
+                if end < 0:
+                    return
+                with memoryview(buf) as view:
+                    start = 0
+                    while start <= end:
+                        stop = buf.find(b"\n\n", start)
+                        with view[start:stop] as event:
+                            if event[:6] == b"data: " and event[6:] != b"[DONE]":
+                                try:
+                                    consume(event[6:])
+                                except Exception:
+                                    pass
+                        start = stop + 2
+                del buf[:end + 2]
+
+            try:
+                if not log_prompt:
+                    # 로깅 꺼짐 또는 추론 엔드포인트가 아님: 버퍼링/파싱 없이 받은 청크를 그대로 전달
+                    async for chunk in r.aiter_raw():
                         yield chunk
-                        try:
-                            line = chunk.decode("utf-8", errors="replace")
-                            if line.strip().startswith("data: ") and "[DONE]" not in line:
-                                payload = line.split("data: ", 1)[1].strip()
-                                data = json.loads(payload)
-                                if "usage" in data:
-                                    stream_usage = extract_usage_from_response(data)
-                                for choice in data.get("choices") or []:
-                                    delta = choice.get("delta") or {}
-                                    if "content" in delta and delta["content"]:
-                                        full_content.append(delta["content"])
-                                    # 스트리밍 툴콜: delta.tool_calls는 index별로 올 수 있음
-                                    for tc in delta.get("tool_calls") or []:
-                                        if not isinstance(tc, dict):
-                                            continue
-                                        idx = tc.get("index", len(stream_tool_calls))
-                                        while len(stream_tool_calls) <= idx:
-                                            stream_tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
-                                        cur = stream_tool_calls[idx]
-                                        if tc.get("id"):
-                                            cur["id"] = tc["id"]
-                                        if tc.get("type"):
-                                            cur["type"] = tc["type"]
-                                        fn = cur.setdefault("function", {"name": "", "arguments": ""})
-                                        if tc.get("function"):
-                                            if tc["function"].get("name"):
-                                                fn["name"] = tc["function"]["name"]
-                                            if tc["function"].get("arguments"):
-                                                fn["arguments"] = (fn.get("arguments") or "") + tc["function"]["arguments"]
-                        except Exception:
-                            pass
-            if stream_usage:
+                    return
+                async for chunk in r.aiter_raw():
+                    yield chunk
+                    buf += chunk
+                    drain()
+            finally:
+                await r.aclose()
+            if stream_usage is not None:
                 logger.info("=== TOKEN USAGE (stream) === input=%s output=%s total=%s",
-                            stream_usage["prompt_tokens"], stream_usage["completion_tokens"], stream_usage["total_tokens"])
+                            stream_usage.prompt_tokens, stream_usage.completion_tokens, stream_usage.total_tokens)
             if stream_tool_calls:
                 formatted = format_tool_calls(stream_tool_calls)
                 if formatted:
@@ -195,30 +344,27 @@ async def proxy(path: str, request: Request) -> Response:
                 logger.info("=== RESPONSE PROMPT (stream) ===\n%s",
                             response_text)
 
-        return StreamingResponse(
-            stream(),
-            status_code=200,
-            media_type="text/event-stream",
-            headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
-        )
+        # 제너레이터가 시작되기 전에 클라이언트가 끊겨도 업스트림 응답이 닫히도록 background로도 정리
+        response = StreamingResponse(stream(), status_code=r.status_code, background=BackgroundTask(r.aclose))
+        # 업스트림 헤더를 dict 변환/정규화 없이 원본 튜플로 사용 (date/server/hop-by-hop 제외)
+        response.raw_headers = _response_headers(r.headers)
+        return response
 
     # 비스트리밍
-    async with httpx.AsyncClient(timeout=PROXY_TIMEOUT) as client:
-        resp = await client.request(method, url, content=raw_body, headers=headers)
+    resp = await client.request(method, url, content=content, headers=headers)
 
     # 비스트리밍 응답 로깅
-    if resp.status_code == 200 and resp.content:
+    if log_prompt and resp.status_code == 200 and resp.content:
         try:
-            data = resp.json()
-            usage = extract_usage_from_response(data)
+            data = _completion_decoder.decode(resp.content)
+            usage = data.usage or Usage()
             logger.info("=== TOKEN USAGE === input=%s output=%s total=%s",
-                        usage["prompt_tokens"], usage["completion_tokens"], usage["total_tokens"])
+                        usage.prompt_tokens, usage.completion_tokens, usage.total_tokens)
             response_text = extract_response_text(data)
             logger.info("=== RESPONSE PROMPT ===\n%s", response_text)
             # 응답 message에 tool_calls 있으면 툴 정보 로그
-            choices = data.get("choices") or []
-            if choices and "message" in choices[0]:
-                tcs = (choices[0].get("message") or {}).get("tool_calls")
+            if data.choices and data.choices[0].message is not None:
+                tcs = data.choices[0].message.tool_calls
                 if tcs:
                     formatted = format_tool_calls(tcs)
                     if formatted:
@@ -226,12 +372,10 @@ async def proxy(path: str, request: Request) -> Response:
         except Exception as e:
             logger.debug("Response log parse skip: %s", e)
 
-    return Response(
-        content=resp.content,
-        status_code=resp.status_code,
-        headers=dict(resp.headers),
-        media_type=resp.headers.get("content-type"),
-    )
+    response = Response(content=resp.content, status_code=resp.status_code)
+    # 업스트림 헤더(content-type 포함)를 dict 변환 없이 원본 튜플로 사용 (date/server/hop-by-hop 제외)
+    response.raw_headers = _response_headers(resp.headers)
+    return response
 
 
 @app.get("/health")